@@ -72,7 +72,7 @@ class FasterRCNNAgent(object):
 
         batch = replay_buffer.sample(self.batch_size)
 
-        img = CUDA(torch.FloatTensor(batch['image']))
+        img = CUDA(batch['image'])
         label = torch.FloatTensor(batch['label']).squeeze(1)
         label = CUDA(torch.cat([self._batch_id, label], dim=1))
 
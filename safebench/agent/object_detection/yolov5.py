@@ -140,7 +140,7 @@ class YoloAgent(object):
 
         batch = replay_buffer.sample(self.batch_size)
 
-        img = CUDA(torch.FloatTensor(batch['image']))
+        img = CUDA(batch['image'])
         label = torch.FloatTensor(batch['label']).squeeze(1)
         label = CUDA(torch.cat([self._batch_id, label], dim=1))
 
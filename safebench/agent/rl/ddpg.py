@@ -135,11 +135,11 @@ class DDPG(BasePolicy):
         for it in range(self.update_iteration):
             # sample replay buffer
             batch = replay_buffer.sample(self.batch_size)
-            state = CUDA(torch.FloatTensor(batch['state']))
-            action = CUDA(torch.FloatTensor(batch['action']))
-            reward = CUDA(torch.FloatTensor(batch['reward'])).unsqueeze(-1) # [B, 1]
-            next_state = CUDA(torch.FloatTensor(batch['n_state']))
-            done = CUDA(torch.FloatTensor(1-batch['done'])).unsqueeze(-1) # [B, 1]
+            state = CUDA(batch['state'])
+            action = CUDA(batch['action'])
+            reward = CUDA(batch['reward']).unsqueeze(-1) # [B, 1]
+            next_state = CUDA(batch['n_state'])
+            done = CUDA(1-batch['done']).unsqueeze(-1) # [B, 1]
 
             # Compute the target Q value
             target_Q = self.critic_target(next_state, self.actor_target(next_state))
@@ -170,11 +170,11 @@ class TD3(BasePolicy):
         for _ in range(self.update_iteration):
             # sample replay buffer
             batch = replay_buffer.sample(self.batch_size)
-            state_batch = CUDA(torch.FloatTensor(batch['state']))
-            nextstate_batch = CUDA(torch.FloatTensor(batch['n_state']))
-            action_batch = CUDA(torch.FloatTensor(batch['action']))
-            reward_batch = CUDA(torch.FloatTensor(batch['reward'])).unsqueeze(-1) # [B, 1]
-            done_batch = CUDA(torch.FloatTensor(1-batch['done'])).unsqueeze(-1) # [B, 1]
+            state_batch = CUDA(batch['state'])
+            nextstate_batch = CUDA(batch['n_state'])
+            action_batch = CUDA(batch['action'])
+            reward_batch = CUDA(batch['reward']).unsqueeze(-1) # [B, 1]
+            done_batch = CUDA(1-batch['done']).unsqueeze(-1) # [B, 1]
 
             # update q-funcs
             q1_loss_step, q2_loss_step = self.update_q_functions(state_batch, action_batch, reward_batch,
@@ -11,10 +11,39 @@ Description:
 import numpy as np
 import torch
 
+from safebench.util.torch_util import get_torch_device
+
+
+class ScalarBuffer:
+    """
+        An appendable buffer of scalars backed by a contiguous array, grown by doubling.
+    """
+
+    def __init__(self, dtype=np.float32, init_capacity=64):
+        self._data = np.empty(init_capacity, dtype=dtype)
+        self._len = 0
+
+    def append(self, value):
+        if self._len == len(self._data):
+            self._data = np.resize(self._data, 2 * len(self._data))
+        self._data[self._len] = value
+        self._len += 1
+
+    @property
+    def data(self):
+        return self._data[:self._len]
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        return self.data[index]
+
 
 class RouteReplayBuffer:
     """
         This buffer supports parallel storing transitions from multiple trajectories.
+        The transitions are kept on the model device so that sampled batches can be used without copy.
     """
     
     def __init__(self, num_scenario, mode, buffer_capacity=1000):
@@ -22,6 +51,12 @@ class RouteReplayBuffer:
         self.buffer_capacity = buffer_capacity
         self.num_scenario = num_scenario
         self.buffer_len = 0
+        self.device = get_torch_device()
+        self._extra_keys = None  # keys of additional information, recorded at the first store
+
+        # episode rewards are accumulated separately since episodes can be longer than the ring buffers
+        self.running_episode_reward = np.zeros(self.num_scenario)
+        self.last_episode_reward = np.zeros(self.num_scenario)
 
         # buffers for step info
         self.reset_buffer()
@@ -30,28 +65,46 @@ class RouteReplayBuffer:
         self.reset_init_buffer()
 
     def reset_buffer(self):
-        self.buffer_ego_actions = [[] for _ in range(self.num_scenario)]
-        self.buffer_scenario_actions = [[] for _ in range(self.num_scenario)]
-        self.buffer_obs = [[] for _ in range(self.num_scenario)]
-        self.buffer_next_obs = [[] for _ in range(self.num_scenario)]
-        self.buffer_rewards = [[] for _ in range(self.num_scenario)]
-        self.buffer_dones = [[] for _ in range(self.num_scenario)]
+        # ring buffers are allocated at the first store since the shapes are unknown before
+        self.samples_per_trajectory = max(1, self.buffer_capacity // self.num_scenario) # assume average over all sub-buffer
+        self.buffer_ego_actions = None
+        self.buffer_scenario_actions = None
+        self.buffer_obs = None
+        self.buffer_next_obs = None
+        self.buffer_rewards = None
+        self.buffer_dones = None
+        self.write_idx = np.zeros(self.num_scenario, dtype=np.int64)
+        self.buffer_size = np.zeros(self.num_scenario, dtype=np.int64)
         self.buffer_additional_dict = [{} for _ in range(self.num_scenario)]
+        if self._extra_keys is not None:
+            self._reset_additional_dict()
+
+    def _reset_additional_dict(self):
+        self.buffer_additional_dict = [{key: [] for key in self._extra_keys} for _ in range(self.num_scenario)]
+
+    def _allocate_buffer(self, data, dtype=torch.float32):
+        # the shape of one sample is [num_scenario, samples_per_trajectory, *feature_shape]
+        if data[0] is None:
+            return None
+        shape = np.shape(data[0])
+        return torch.empty((self.num_scenario, self.samples_per_trajectory, *shape), dtype=dtype, device=self.device)
+
+    def _to_tensor(self, data, dtype=torch.float32):
+        if data is None or data[0] is None:
+            return None
+        return torch.as_tensor(np.asarray(data), dtype=dtype).to(self.device, non_blocking=True)
 
     def reset_init_buffer(self):
         self.buffer_static_obs = []
         self.buffer_init_action = []
-        self.buffer_episode_reward = []
+        self.buffer_episode_reward = ScalarBuffer()
         self.buffer_init_additional_dict = {}
         self.init_buffer_len = 0
 
     def finish_one_episode(self):
         # get total reward for episode
         for s_i in range(self.num_scenario):
-            dones = np.where(self.buffer_dones[s_i])[0]
-            start_ = dones[-2] if len(dones) > 1 else -1
-            end_ = dones[-1]
-            self.buffer_episode_reward.append(np.sum(self.buffer_rewards[s_i][start_+1:end_+1]))
+            self.buffer_episode_reward.append(self.last_episode_reward[s_i])
 
     def store(self, data_list, additional_dict):
         ego_actions = data_list[0]
@@ -62,23 +115,51 @@ class RouteReplayBuffer:
         dones = data_list[5]
         self.buffer_len += len(rewards)
 
-        # separate trajectories according to infos
-        for s_i in range(len(additional_dict)):
-            sid = additional_dict[s_i]['scenario_id']
-            self.buffer_ego_actions[sid].append(ego_actions[s_i])
-            self.buffer_scenario_actions[sid].append(scenario_actions[s_i])
-            self.buffer_obs[sid].append(obs[s_i])
-            self.buffer_next_obs[sid].append(next_obs[s_i])
-            self.buffer_rewards[sid].append(rewards[s_i])
-            self.buffer_dones[sid].append(dones[s_i])
+        if self.buffer_rewards is None:
+            self.buffer_ego_actions = self._allocate_buffer(ego_actions)
+            self.buffer_scenario_actions = self._allocate_buffer(scenario_actions)
+            self.buffer_obs = self._allocate_buffer(obs)
+            self.buffer_next_obs = self._allocate_buffer(next_obs)
+            self.buffer_rewards = self._allocate_buffer(rewards)
+            self.buffer_dones = self._allocate_buffer(dones, dtype=torch.int8)
+
+        # the keys of additional information are assumed to be the same for all steps
+        if self._extra_keys is None:
+            self._extra_keys = tuple(key for key in additional_dict[0] if key != 'scenario_id')
+            self._reset_additional_dict()
+
+        # accumulate the episode rewards on host before the step is moved to the device
+        sids = np.fromiter((info['scenario_id'] for info in additional_dict), dtype=np.int64, count=len(additional_dict))
+        for s_i, sid in enumerate(sids):
+            self.running_episode_reward[sid] += rewards[s_i]
+            if dones[s_i]:
+                self.last_episode_reward[sid] = self.running_episode_reward[sid]
+                self.running_episode_reward[sid] = 0.0
+
+        # move the whole step to the device once
+        ego_actions, scenario_actions = self._to_tensor(ego_actions), self._to_tensor(scenario_actions)
+        obs, next_obs = self._to_tensor(obs), self._to_tensor(next_obs)
+        rewards, dones = self._to_tensor(rewards), self._to_tensor(dones, dtype=torch.int8)
+
+        # separate trajectories according to infos, all samples of one scenario are written at once
+        for sid in np.unique(sids):
+            index = np.flatnonzero(sids == sid)
+            slots = (self.write_idx[sid] + np.arange(len(index))) % self.samples_per_trajectory
+            if self.buffer_ego_actions is not None:
+                self.buffer_ego_actions[sid, slots] = ego_actions[index]
+            if self.buffer_scenario_actions is not None:
+                self.buffer_scenario_actions[sid, slots] = scenario_actions[index]
+            self.buffer_obs[sid, slots] = obs[index]
+            self.buffer_next_obs[sid, slots] = next_obs[index]
+            self.buffer_rewards[sid, slots] = rewards[index]
+            self.buffer_dones[sid, slots] = dones[index]
+            self.write_idx[sid] = (self.write_idx[sid] + len(index)) % self.samples_per_trajectory
+            self.buffer_size[sid] = min(self.buffer_size[sid] + len(index), self.samples_per_trajectory)
 
             # store additional information in given dict (e.g., cost)
-            for key in additional_dict[s_i].keys():
-                if key == 'scenario_id':
-                    continue
-                if key not in self.buffer_additional_dict[s_i].keys():
-                    self.buffer_additional_dict[s_i][key] = []
-                self.buffer_additional_dict[s_i][key].append(additional_dict[s_i][key])
+            buffer_additional_dict = self.buffer_additional_dict[sid]
+            for key in self._extra_keys:
+                buffer_additional_dict[key].extend(additional_dict[i][key] for i in index)
 
     def store_init(self, data_list, additional_dict=None):
         static_obs = data_list[0]
@@ -98,60 +179,51 @@ class RouteReplayBuffer:
         num_trajectory = len(self.buffer_init_action)
         start_idx = np.max([0, num_trajectory - self.buffer_capacity]) 
 
+        # each stored init action is a chunk of rows, get the row offset of each chunk
+        chunk_len = np.fromiter((len(a) for a in self.buffer_init_action), dtype=np.int64, count=num_trajectory)
+        row_start = chunk_len[:start_idx].sum()
+        chunk_offset = np.concatenate(([0], np.cumsum(chunk_len[start_idx:])))
+
         # select up-to-date samples from buffer
         prepared_init_action =  self.buffer_init_action[start_idx:]
-        prepared_episode_reward = self.buffer_episode_reward[start_idx:]
+        prepared_episode_reward = self.buffer_episode_reward[row_start:]
 
-        # sample action and episode reward
-        sample_index = np.random.randint(0, len(prepared_init_action), size=batch_size)
-        init_action = np.concatenate(prepared_init_action, axis=0)[sample_index]
-        episode_reward = np.array(prepared_episode_reward)[sample_index]
+        # sample rows and map them to (chunk, row) without concatenating all chunks
+        sample_index = np.random.randint(0, chunk_offset[-1], size=batch_size)
+        chunk_index = np.searchsorted(chunk_offset, sample_index, side='right') - 1
+        row_index = sample_index - chunk_offset[chunk_index]
+        init_action = np.empty((batch_size, *np.shape(prepared_init_action[0])[1:]), dtype=np.asarray(prepared_init_action[0]).dtype)
+        for i in range(batch_size):
+            init_action[i] = prepared_init_action[chunk_index[i]][row_index[i]]
+        episode_reward = prepared_episode_reward[sample_index]
         batch = {
             'init_action': init_action,
             'episode_reward': episode_reward,
         }
 
-        # add additional information to the batch (assume with torch)
+        # add additional information to the batch (assume with torch and the same rows as init action)
         for key in self.buffer_init_additional_dict.keys():
-            batch[key] = torch.cat(self.buffer_init_additional_dict[key][start_idx:])[sample_index]
+            prepared_additional = self.buffer_init_additional_dict[key][start_idx:]
+            batch[key] = torch.stack([prepared_additional[c][r] for c, r in zip(chunk_index, row_index)])
         return batch
 
     def sample(self, batch_size):
-        # prepare concatenated list
-        prepared_ego_actions = []
-        prepared_scenario_actions = []
-        prepared_obs = []
-        prepared_next_obs = []
-        prepared_rewards = []
-        prepared_dones = []
-
-        # get the length of each sub-buffer
-        samples_per_trajectory = self.buffer_capacity // self.num_scenario # assume average over all sub-buffer
-        for s_i in range(self.num_scenario):
-            # select the latest samples starting from the end of buffer
-            num_trajectory = len(self.buffer_rewards[s_i])
-            start_idx = np.max([0, num_trajectory - samples_per_trajectory])
-
-            # concat
-            prepared_ego_actions += self.buffer_ego_actions[s_i][start_idx:]
-            prepared_scenario_actions += self.buffer_scenario_actions[s_i][start_idx:]
-            prepared_obs += self.buffer_obs[s_i][start_idx:]
-            prepared_next_obs += self.buffer_next_obs[s_i][start_idx:]
-            prepared_rewards += self.buffer_rewards[s_i][start_idx:]
-            prepared_dones += self.buffer_dones[s_i][start_idx:]
-
-        # sample from concatenated list
-        sample_index = np.random.randint(0, len(prepared_rewards), size=batch_size)
-        if self.mode == 'train_agent':
-            action = np.stack(prepared_ego_actions)[sample_index]       # action of agent
-        else:
-            action = np.stack(prepared_scenario_actions)[sample_index]  # action of scenario
+        # sample uniformly from all stored samples, the latest samples are kept by the ring buffers
+        # the index is computed on host and moved to the device once, so sampling never waits for the device
+        size_offset = np.concatenate(([0], np.cumsum(self.buffer_size)))
+        sample_index = np.random.randint(0, size_offset[-1], size=batch_size)
+        sid_index = np.searchsorted(size_offset, sample_index, side='right') - 1
+        flat_index = sid_index * self.samples_per_trajectory + sample_index - size_offset[sid_index]
+        flat_index = torch.as_tensor(flat_index, device=self.device)
+
+        # gather the batch on device with one flat index shared by all fields, all returned values are torch tensors
+        buffer_actions = self.buffer_ego_actions if self.mode == 'train_agent' else self.buffer_scenario_actions
         batch = {
-            'action': action,                                         # action
-            'state': np.stack(prepared_obs)[sample_index, :],         # state
-            'n_state': np.stack(prepared_next_obs)[sample_index, :],  # next state
-            'reward': np.stack(prepared_rewards)[sample_index],       # reward
-            'done': np.stack(prepared_dones)[sample_index],           # done
+            'action': None if buffer_actions is None else buffer_actions.flatten(0, 1)[flat_index],  # action of agent or scenario
+            'state': self.buffer_obs.flatten(0, 1)[flat_index],                                      # state
+            'n_state': self.buffer_next_obs.flatten(0, 1)[flat_index],                               # next state
+            'reward': self.buffer_rewards.flatten(0, 1)[flat_index],                                 # reward
+            'done': self.buffer_dones.flatten(0, 1)[flat_index].float(),                             # done
         }
         return batch
 
@@ -159,6 +231,8 @@ class RouteReplayBuffer:
 class PerceptionReplayBuffer:
     """
         This buffer supports parallel storing image states and labels for object detection
+        The images are kept as uint8 on the model device and converted to float (same scale) when sampled.
+        The device ring buffers grow as they fill, so memory is only taken for the stored images.
     """
     
     def __init__(self, num_scenario, mode, buffer_capacity=1000):
@@ -166,13 +240,28 @@ class PerceptionReplayBuffer:
         self.buffer_capacity = buffer_capacity
         self.num_scenario = num_scenario
         self.buffer_len = 0
+        self.device = get_torch_device()
+        self.samples_per_trajectory = max(1, buffer_capacity // num_scenario) # assume average over all sub-buffer
+
+        # ring buffers for different data type, allocated at the first store since the shapes are unknown before
+        self.buffer_bbox_label = None           # perception labels
+        self.buffer_predictions = None          # perception outputs
+        self.buffer_scenario_actions = None     # synthetic textures (attack)
+        self.buffer_obs = None                  # image observations (FPV observation)
+        self.buffer_loss = None                 # object detection loss (IoU, class, etc.)
+        self.write_idx = np.zeros(num_scenario, dtype=np.int64)
+        self.buffer_size = np.zeros(num_scenario, dtype=np.int64)
+        self.device_capacity = 0                # slots per scenario allocated on device, up to samples_per_trajectory
 
-        # buffers for different data type
-        self.buffer_bbox_label = [[] for _ in range(num_scenario)]          # perception labels
-        self.buffer_predictions = [[] for _ in range(num_scenario)]         # perception outputs
-        self.buffer_scenario_actions = [[] for _ in range(num_scenario)]    # synthetic textures (attack)
-        self.buffer_obs = [[] for _ in range(num_scenario)]                 # image observations (FPV observation)
-        self.buffer_loss = [[] for _ in range(num_scenario)]                # object detection loss (IoU, class, etc.)
+    def _grow_device_buffer(self, num_slots):
+        # double the allocated slots (at least to num_slots) and keep the stored samples
+        capacity = min(max(num_slots, 2 * self.device_capacity), self.samples_per_trajectory)
+        buffer_obs = torch.empty((self.num_scenario, capacity, *self.buffer_obs.shape[2:]), dtype=torch.uint8, device=self.device)
+        buffer_loss = torch.empty((self.num_scenario, capacity), dtype=torch.float32, device=self.device)
+        buffer_obs[:, :self.device_capacity] = self.buffer_obs
+        buffer_loss[:, :self.device_capacity] = self.buffer_loss
+        self.buffer_obs, self.buffer_loss = buffer_obs, buffer_loss
+        self.device_capacity = capacity
     
     def finish_one_episode(self):
         pass
@@ -180,7 +269,7 @@ class PerceptionReplayBuffer:
     def reset_init_buffer(self):
         self.buffer_static_obs = []
         self.buffer_init_action = []
-        self.buffer_episode_reward = []
+        self.buffer_episode_reward = ScalarBuffer()
         self.buffer_init_additional_dict = {}
         self.init_buffer_len = 0
     
@@ -193,45 +282,56 @@ class PerceptionReplayBuffer:
         obs = data_list[2]
         self.buffer_len += len(ego_actions)
 
-        # separate trajectories according to infos
-        for s_i in range(len(additional_dict)):
-            sid = additional_dict[s_i]['scenario_id']
-            self.buffer_predictions[sid].append(ego_actions[s_i]['od_result'])
-            self.buffer_scenario_actions[sid].append(scenario_actions[s_i]['attack'])
-            self.buffer_obs[sid].append(obs[s_i]['img'])
-            self.buffer_bbox_label[sid].append(additional_dict[s_i]['bbox_label'])
-            self.buffer_loss[sid].append(additional_dict[s_i]['iou_loss'])
+        if self.buffer_obs is None:
+            ring_shape = (self.num_scenario, self.samples_per_trajectory)
+            bbox_label = np.asarray(additional_dict[0]['bbox_label'])
+            self.buffer_bbox_label = np.empty((*ring_shape, *bbox_label.shape), dtype=bbox_label.dtype)
+            self.buffer_predictions = np.empty(ring_shape, dtype=object)
+            self.buffer_scenario_actions = np.empty(ring_shape, dtype=object)
+            self.buffer_obs = torch.empty((self.num_scenario, 0, *np.shape(obs[0]['img'])), dtype=torch.uint8, device=self.device)
+            self.buffer_loss = torch.empty((self.num_scenario, 0), dtype=torch.float32, device=self.device)
+
+        # stack the step on host and move images and losses to the device once
+        sids = np.fromiter((info['scenario_id'] for info in additional_dict), dtype=np.int64, count=len(additional_dict))
+        bbox_label = np.stack([info['bbox_label'] for info in additional_dict])
+        img = torch.as_tensor(np.stack([o['img'] for o in obs])).to(self.device, torch.uint8, non_blocking=True)
+        loss = np.fromiter((float(info['iou_loss']) for info in additional_dict), dtype=np.float32, count=len(additional_dict))
+        loss = torch.as_tensor(loss).to(self.device, non_blocking=True)
+
+        # the slots are written in order until a ring buffer is full, so only the used slots need to be allocated
+        num_slots = min(int((self.buffer_size + np.bincount(sids, minlength=self.num_scenario)).max()), self.samples_per_trajectory)
+        if num_slots > self.device_capacity:
+            self._grow_device_buffer(num_slots)
+
+        # separate trajectories according to infos, all samples of one scenario are written at once
+        for sid in np.unique(sids):
+            index = np.flatnonzero(sids == sid)
+            slots = (self.write_idx[sid] + np.arange(len(index))) % self.samples_per_trajectory
+            for slot, s_i in zip(slots, index):
+                self.buffer_predictions[sid, slot] = ego_actions[s_i]['od_result']
+                self.buffer_scenario_actions[sid, slot] = scenario_actions[s_i]['attack']
+            self.buffer_bbox_label[sid, slots] = bbox_label[index]
+            self.buffer_obs[sid, slots] = img[index]
+            self.buffer_loss[sid, slots] = loss[index]
+            self.write_idx[sid] = (self.write_idx[sid] + len(index)) % self.samples_per_trajectory
+            self.buffer_size[sid] = min(self.buffer_size[sid] + len(index), self.samples_per_trajectory)
 
     def sample(self, batch_size):
-        # prepare concatenated list
-        prepared_bbox_label = []
-        prepared_predictions = []
-        prepared_obs = []
-        prepared_scenario_actions = []
-        prepared_loss = []
-        # get the length of each sub-buffer
-        samples_per_trajectory = self.buffer_capacity // self.num_scenario # assume average over all sub-buffer
-        for s_i in range(self.num_scenario):
-            # select the latest samples starting from the end of buffer
-            num_trajectory = len(self.buffer_loss[s_i])
-            start_idx = np.max([0, num_trajectory - samples_per_trajectory])
-
-            # concat
-            prepared_bbox_label += self.buffer_bbox_label[s_i][start_idx:]
-            prepared_predictions += self.buffer_predictions[s_i][start_idx:]
-            prepared_scenario_actions += self.buffer_scenario_actions[s_i][start_idx:]
-            prepared_obs += self.buffer_obs[s_i][start_idx:]
-            prepared_loss += self.buffer_loss[s_i][start_idx:]
-        # sample from concatenated list
-        sample_index = np.random.randint(0, len(prepared_loss), size=batch_size)
+        # sample uniformly from all stored samples, the latest samples are kept by the ring buffers
+        size_offset = np.concatenate(([0], np.cumsum(self.buffer_size)))
+        sample_index = np.random.randint(0, size_offset[-1], size=batch_size)
+        sid_index = np.searchsorted(size_offset, sample_index, side='right') - 1
+        slot_index = sample_index - size_offset[sid_index]
+        flat_index = sid_index * self.samples_per_trajectory + slot_index
+        device_flat_index = torch.as_tensor(sid_index * self.device_capacity + slot_index, device=self.device)
 
+        # gather with one flat index shared by all fields
         batch = {
-            'label': np.stack(prepared_bbox_label)[sample_index, :],        
-            # 'prediction': np.stack(prepared_predictions)[sample_index, :],     # TODO: Multiple/empty predictions should be stacked together
-            # 'attack': np.stack(prepared_scenario_actions)[sample_index, :],
-            # 'attack': torch.stack(prepared_scenario_actions)[sample_index, :],
-            'image': np.stack(prepared_obs)[sample_index, :],
-            'loss': np.stack(prepared_loss)[sample_index],                       # scalar with 1D 
+            'label': self.buffer_bbox_label.reshape(-1, *self.buffer_bbox_label.shape[2:])[flat_index],
+            # 'prediction': self.buffer_predictions.reshape(-1)[flat_index],     # TODO: Multiple/empty predictions should be stacked together
+            # 'attack': self.buffer_scenario_actions.reshape(-1)[flat_index],
+            'image': self.buffer_obs.flatten(0, 1)[device_flat_index].float(),  # image in [0, 255] as stored
+            'loss': self.buffer_loss.flatten(0, 1)[device_flat_index],                      # scalar with 1D 
         }
         
         return batch
@@ -13,6 +13,7 @@ Description:
 
 import carla
 import json
+import numpy as np
 
 from safebench.scenario.tools.scenario_operation import ScenarioOperation
 from safebench.scenario.tools.scenario_utils import calculate_distance_transforms
@@ -73,10 +74,10 @@ class OtherLeadingVehicle(BasicScenario):
 
         self.step = 0
         with open(config.parameters, 'r') as f:
-            parameters = json.load(f)
-        self.control_seq = [(control * 2 - 1) * 2 for control in parameters]
-        self.total_steps = len(self.control_seq)
-        self.actor_transform_list = []
+            parameters = np.asarray(json.load(f), dtype=np.float32)
+        self.control_seq = parameters * 4.0 - 2.0
+        self.total_steps = parameters.shape[0]
+        self.perturbed_actor_locations = None
         self.perturbed_actor_transform_list = []
         self.running_distance = 50
 
@@ -99,20 +100,25 @@ class OtherLeadingVehicle(BasicScenario):
         self.second_vehicle_transform = carla.Transform(second_vehicle_waypoint.transform.location,
                                                        second_vehicle_waypoint.transform.rotation)
 
-        forward_vector = self._first_actor_transform.rotation.get_forward_vector() * self.running_distance
-        right_vector = self._first_actor_transform.rotation.get_right_vector()
-        self.other_actor_final_transform = carla.Transform(
-            self._first_actor_transform.location,
-            self._first_actor_transform.rotation)
-        self.other_actor_final_transform.location += forward_vector
-        for i in range(self.total_steps):
-            self.actor_transform_list.append(carla.Transform(
-                carla.Location(self._first_actor_transform.location + forward_vector * i / self.total_steps),
-                self._first_actor_transform.rotation))
-        for i in range(self.total_steps):
-            self.perturbed_actor_transform_list.append(carla.Transform(
-                carla.Location(self.actor_transform_list[i].location + right_vector * self.control_seq[i]),
-                self._first_actor_transform.rotation))
+        # cache the rotation and its direction vectors, they are shared by all trajectory points
+        self._rot = self._first_actor_transform.rotation
+        self._fwd = self._rot.get_forward_vector() * self.running_distance
+        self._rgt = self._rot.get_right_vector()
+        self._origin = self._first_actor_transform.location
+        self.other_actor_final_transform = carla.Transform(self._origin, self._rot)
+        self.other_actor_final_transform.location += self._fwd
+
+        # compute the whole perturbed trajectory at once, only wrapping into carla objects stays in python
+        origin = np.array([self._origin.x, self._origin.y, self._origin.z])
+        forward = np.array([self._fwd.x, self._fwd.y, self._fwd.z])
+        right = np.array([self._rgt.x, self._rgt.y, self._rgt.z])
+        progress = np.arange(self.total_steps) / self.total_steps
+        self.perturbed_actor_locations = origin + progress[:, None] * forward + self.control_seq[:, None] * right
+        self.perturbed_actor_transform_list = [
+            carla.Transform(carla.Location(x, y, z), self._rot)
+            for x, y, z in self.perturbed_actor_locations.tolist()
+        ]
+        self._perturbed = self.perturbed_actor_transform_list  # local alias used in the per-tick update
 
         # print('other_actor_transform')
         # for i in self.other_actor_transform:
@@ -129,14 +135,16 @@ class OtherLeadingVehicle(BasicScenario):
         """
         # cur_distance = calculate_distance_transforms(CarlaDataProvider.get_transform(self.ego_vehicles[0]),
         #                                              CarlaDataProvider.get_transform(self.other_actors[1]))
-        cur_distance = calculate_distance_transforms(self.other_actor_transform[0], CarlaDataProvider.get_transform(self.other_actors[0]))
-
-        if cur_distance > self.dece_distance:
-            self.need_decelerate = True
+        # the distance is only needed before the deceleration is triggered
+        if not self.need_decelerate:
+            cur_distance = calculate_distance_transforms(self.other_actor_transform[0], CarlaDataProvider.get_transform(self.other_actors[0]))
+            if cur_distance > self.dece_distance:
+                self.need_decelerate = True
         for i in range(len(self.other_actors)):
             if i == 0 and self.need_decelerate:
                 # print(self.step)
-                target_transform = self.perturbed_actor_transform_list[self.step if self.step < self.total_steps else -1]
+                idx = self.step if self.step < self.total_steps else self.total_steps - 1
+                target_transform = self._perturbed[idx]
                 self.step += 1  # max 100
                 self.scenario_operation.drive_to_target_followlane(i, target_transform, self.dece_target_speed)
             else:
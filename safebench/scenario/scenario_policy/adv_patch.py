@@ -101,7 +101,7 @@ class ObjectDetection(object):
         batch = replay_buffer.sample(self.batch_size)
 
         # eps = torch.FloatTensor(batch['attack'])
-        loss = CUDA(torch.FloatTensor(batch['loss']))
+        loss = CUDA(batch['loss'])
 
         # print(eps.shape, loss.shape)
 
@@ -48,6 +48,11 @@ if __name__ == '__main__':
     torch.set_num_threads(args.threads)
     set_seed(args.seed)
 
+    # allow TF32 for matmul and convolution on Ampere or newer GPUs
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # load agent config
     agent_config_path = osp.join(args.ROOT_DIR, 'safebench/agent/config', args.agent_cfg)
     agent_config = load_config(agent_config_path)